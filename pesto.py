@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 # Copyright 2019 The Bazel Authors. All rights reserved.
 #
 # Licensed under the Apache License, Version 2.0 (the "License");
@@ -13,14 +13,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from collections import defaultdict
+from bisect import bisect_left
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+import hashlib
 import json
-from functools import total_ordering
 import os
-import re
+from pathlib import Path
 import subprocess
 import sys
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson parses manifests straight from bytes and much faster, but it's optional.
+_json_loads = orjson.loads if orjson else json.loads
 
 
 class LocalDepedencyNotAllowedError(Exception):
@@ -33,8 +44,9 @@ class VersionParseError(Exception):
 
 
 def _InvokeSystemCommand(args, inputstr=None):
+    # Only create a pipe for stdin when there's something to write to it.
     proc = subprocess.Popen(args,
-        stdin=subprocess.PIPE,
+        stdin=subprocess.PIPE if inputstr is not None else subprocess.DEVNULL,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE)
     stdout, stderr = proc.communicate(input=inputstr)
@@ -43,44 +55,92 @@ def _InvokeSystemCommand(args, inputstr=None):
         raise subprocess.CalledProcessError(proc.returncode, args)
     return stdout, stderr
 
-_COMPONENT_REGEX = re.compile("^(\d+)(?:([a-z]+)(\d*))?$")
+# Maximum number of blob requests written to a cat-file process before reading their responses.
+_CAT_FILE_BATCH_SIZE = 64
 
-@total_ordering
-class DottedVersionComponent:
-    def __init__(self, component_str):
-        self._original = component_str
-        match = _COMPONENT_REGEX.search(component_str)
+# Number of concurrent git operations used when collecting dependencies, and when cloning or
+# updating repos.
+_MAX_GIT_WORKERS = 16
+_MAX_FETCH_WORKERS = 32
+
+# Minimum number of manifests in a batch for them to be parsed in a process pool, and how many
+# manifests are sent to each worker at a time.
+_PARSE_PROCESSES_THRESHOLD = 256
+_PARSE_PROCESSES_CHUNK_SIZE = 32
+
+# Versions and their components are immutable, and the same strings repeat across the tags of
+# every repo, so instances are interned by the string they were parsed from.
+_INTERNED_COMPONENTS = {}
+_INTERNED_VERSIONS = {}
 
-        self._first_number = int(match.group(1))
-        self._string = match.group(2)
-        self._second_number = match.group(3) or 0
+# Parsed manifests by the sha of their blob. Tags often share an unchanged manifest, and identical
+# manifests may live in different repos, so they're shared by every GitRepo.
+_MANIFESTS_BY_BLOB = {}
+
+class DottedVersionComponent:
+    def __new__(cls, component_str):
+        component = _INTERNED_COMPONENTS.get(component_str)
+        if component is not None:
+            return component
+
+        component = super(DottedVersionComponent, cls).__new__(cls)
+        component._original = component_str
+
+        # Components have the form <digits>[<lowercase letters><digits>], e.g. "2" or "0rc1".
+        # They're short, so scanning them by hand is cheaper than matching a regex.
+        length = len(component_str)
+        idx = 0
+        while idx < length and "0" <= component_str[idx] <= "9":
+            idx += 1
+        string_start = idx
+        while idx < length and "a" <= component_str[idx] <= "z":
+            idx += 1
+        second_number_start = idx
+        while idx < length and "0" <= component_str[idx] <= "9":
+            idx += 1
+
+        if string_start == 0 or idx != length:
+            raise VersionParseError("Invalid version component: {}".format(component_str))
+
+        component._first_number = int(component_str[:string_start])
+        component._string = component_str[string_start:second_number_start] or None
+        component._second_number = int(component_str[second_number_start:] or 0)
+
+        # Components are ordered by this key, where components without a string sort above
+        # pre-release ones.
+        component._key = (
+            component._first_number,
+            component._string is None,
+            component._string or "",
+            component._second_number,
+        )
+        return _INTERNED_COMPONENTS.setdefault(component_str, component)
 
     def __eq__(self, other):
-        return (self._first_number == other._first_number and
-                self._string == other._string and
-                self._second_number == other._second_number)
+        return self._key == other._key
 
     def __ne__(self, other):
-        return not self.__eq__(other)
+        return self._key != other._key
 
-    def __gt__(self, other):
-        if self._first_number != other._first_number:
-            return self._first_number > other._first_number
+    def __lt__(self, other):
+        return self._key < other._key
 
-        if self._string == other._string:
-            return self._second_number > other._second_number
+    def __le__(self, other):
+        return self._key <= other._key
 
-        if self._string and other._string == None:
-            return False
-
-        if other._string and self._string == None:
-            return True
+    def __gt__(self, other):
+        return self._key > other._key
 
-        return self._string > other._string
+    def __ge__(self, other):
+        return self._key >= other._key
 
     def __hash__(self):
         return hash((self._first_number, self._string, self._second_number))
 
+    def __reduce__(self):
+        # Unpickled components are interned like any other.
+        return (DottedVersionComponent, (self._original,))
+
     def __str__(self):
         return self._original
 
@@ -95,50 +155,71 @@ class DottedVersionComponent:
 
 ZERO_COMPONENT = DottedVersionComponent("0")
 
-@total_ordering
 class DottedVersion:
-    def __init__(self, version_str):
-        self._components = [DottedVersionComponent(x) for x in version_str.split(".")]
-
-        # Canonicalize by removing trailing zero components.
-        while len(self._components) > 0 and self._components[-1] == ZERO_COMPONENT:
-            self._components.pop(-1)
-
-        self._components_length = len(self._components)
+    def __new__(cls, version_str):
+        version = _INTERNED_VERSIONS.get(version_str)
+        if version is not None:
+            return version
+
+        version = super(DottedVersion, cls).__new__(cls)
+        version._original = version_str
+        # Canonicalize by removing trailing zero components, which are dropped before they're
+        # parsed.
+        parts = version_str.split(".")
+        end = len(parts)
+        while end > 0 and parts[end - 1] and not parts[end - 1].strip("0"):
+            end -= 1
+        version._components = [DottedVersionComponent(x) for x in parts[:end]]
+
+        version._components_length = len(version._components)
+
+        # Versions are ordered by this key, comparing missing components as zero. Each zero
+        # component records whether the components after it sort above or below zero, and a final
+        # zero stands for the implicit trailing zeros, so comparing keys as plain tuples also
+        # orders pre-releases correctly (e.g. 1.0.0rc1 < 1).
+        key = [(ZERO_COMPONENT._key, 0)]
+        rest_sign = 0
+        for component in reversed(version._components):
+            if component == ZERO_COMPONENT:
+                key.append((component._key, rest_sign))
+            else:
+                key.append((component._key, 0))
+                rest_sign = 1 if component > ZERO_COMPONENT else -1
+        key.reverse()
+        version._key = tuple(key)
+        version._hash = hash(version._key)
+        return _INTERNED_VERSIONS.setdefault(version_str, version)
 
     def __eq__(self, other):
-        # Because the components have been canonicalized, if the lengths differ, it's because
-        # they're different.
-        if self._components_length != other._components_length:
+        # Versions are interned, so equal version strings are usually the same instance.
+        if self is other:
+            return True
+        if self._hash != other._hash:
             return False
-        for idx in range(self._components_length):
-            if self._components[idx] != other._components[idx]:
-                return False
-        return True
+        return self._key == other._key
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
-    def __gt__(self, other):
-        max_component_count = max(self._components_length, other._components_length)
-        for idx in range(max_component_count):
-            if idx >= self._components_length:
-                self_component = ZERO_COMPONENT
-            else:
-                self_component = self._components[idx]
+    def __lt__(self, other):
+        return self._key < other._key
 
-            if idx >= other._components_length:
-                other_component = ZERO_COMPONENT
-            else:
-                other_component = other._components[idx]
+    def __le__(self, other):
+        return self._key <= other._key
 
-            if self_component != other_component:
-                return self_component > other_component
+    def __gt__(self, other):
+        return self._key > other._key
 
-        return False
+    def __ge__(self, other):
+        return self._key >= other._key
 
     def __hash__(self):
-        return hash(tuple(self._components))
+        return self._hash
+
+    def __reduce__(self):
+        # Unpickled versions are interned like any other. They're rebuilt from the string they were
+        # parsed from, as the canonical form of an all-zero version is empty and can't be parsed.
+        return (DottedVersion, (self._original,))
 
     def __repr__(self):
         return "<DottedVersion> = {}".format(self.canonical)
@@ -189,7 +270,9 @@ class DottedVersionRange:
         return version < self._upper_bound
 
     @staticmethod
-    def intersect(first_range, *version_ranges):
+    def intersect_iter(version_ranges):
+        version_ranges = iter(version_ranges)
+        first_range = next(version_ranges)
         lower_bound = first_range._lower_bound
         upper_bound = first_range._upper_bound
         upper_bound_inclusive = first_range._upper_bound_inclusive
@@ -211,14 +294,101 @@ class DottedVersionRange:
         )
 
 
+# Reads blobs from a local repo. Blobs are read once per inspected version, so a single long-lived
+# `git cat-file --batch` process serves all of them instead of forking git for each one. Commands
+# that need a fresh process, like clone or fetch, still go through _InvokeSystemCommand.
+class GitClient:
+    def __init__(self, repo_path):
+        self._repo_path = repo_path
+        self._cat_file_proc = None
+        self._lock = threading.Lock()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self._cat_file_proc:
+            self._cat_file_proc.stdin.close()
+            self._cat_file_proc.wait()
+            self._cat_file_proc.stdout.close()
+            self._cat_file_proc = None
+
+    def _readResponse(self, proc):
+        # Returns the sha and contents of the next blob in the output, or None if it was missing.
+        header = proc.stdout.readline().split()
+        if len(header) != 3:
+            return None
+
+        blob_sha = header[0].decode()
+        size = int(header[2])
+        contents = b""
+        # The blob contents are followed by a trailing newline.
+        while len(contents) < size + 1:
+            chunk = proc.stdout.read(size + 1 - len(contents))
+            if not chunk:
+                raise IOError("Unexpected end of output from git cat-file.")
+            contents += chunk
+        return blob_sha, contents[:size]
+
+    def readBlobs(self, revision_paths):
+        # The process is shared, so reads from different threads must not interleave.
+        with self._lock:
+            if not self._cat_file_proc:
+                # The pipes are buffered, so response headers aren't read a byte at a time, and
+                # each batch of requests is flushed once it's written.
+                self._cat_file_proc = subprocess.Popen(
+                    ["git", "-C", self._repo_path, "cat-file", "--batch"],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                )
+
+            # Requests are pipelined in batches small enough to fit in the pipe, so writing a batch
+            # never blocks while git waits for its earlier responses to be read.
+            proc = self._cat_file_proc
+            blobs = []
+            for start in range(0, len(revision_paths), _CAT_FILE_BATCH_SIZE):
+                batch = revision_paths[start:start + _CAT_FILE_BATCH_SIZE]
+                proc.stdin.write("".join(
+                    f"{revision}:{path}\n" for revision, path in batch
+                ).encode())
+                proc.stdin.flush()
+                blobs.extend(self._readResponse(proc) for _ in batch)
+
+        # Every response is consumed before failing, so the output stays in sync for later reads.
+        for (revision, path), blob in zip(revision_paths, blobs):
+            if blob is None:
+                raise IOError("Couldn't read {path} at revision {revision} from {repo}.".format(
+                    path=path,
+                    revision=revision,
+                    repo=self._repo_path,
+                ))
+        return blobs
+
+    def readBlob(self, revision, path):
+        return self.readBlobs([(revision, path)])[0]
+
+
 class GitRepo:
     def __init__(self, url):
         self._url = url
-        self._name = os.path.basename(url)
+        # Urls are always separated by forward slashes, regardless of the platform.
+        self._name = url.rsplit("/", 1)[-1]
+        self._git_argv = ("git", "-C", self._name)
+        # Repos are cloned bare, but earlier clones may have a working tree with a nested git dir.
+        git_dir = os.path.join(self._name, ".git")
+        if not os.path.isdir(git_dir):
+            git_dir = self._name
+        self._refs_cache_path = os.path.join(git_dir, "pesto-refs.json")
         self._revisions = {}
+        self._sorted_versions = []
+        self._sorted_version_keys = []
         self._manifests = {}
-
-        self._update()
+        # Blob sha and contents of prefetched manifests that haven't been read yet, by version.
+        self._prefetched_manifests = {}
+        self._remote_refs_hash = None
+        self._cached_tags = None
+        self._git_client = GitClient(self._name)
+        self._lock = threading.Lock()
 
     @property
     def url(self):
@@ -230,65 +400,197 @@ class GitRepo:
 
     @property
     def versions(self):
-        return self._revisions.keys()
+        return self._sorted_versions
+
+    def _readRefsCache(self):
+        try:
+            with open(self._refs_cache_path, "rb") as contents:
+                return _json_loads(contents.read())
+        except (OSError, ValueError):
+            return None
+
+    def fetch(self):
+        # Listing the remote tags takes a single round trip and transfers no objects. If they
+        # haven't changed since this repo was last fetched, both the fetch and the tag listing in
+        # loadRefs are skipped.
+        stdout, stderr = _InvokeSystemCommand(["git", "ls-remote", "--tags", self._url])
+        self._remote_refs_hash = hashlib.sha256(stdout).hexdigest()
+        self._cached_tags = None
 
-    def _update(self):
         if not os.path.exists(self._name):
             print("Cloning repo {}...".format(self._url))
-            _InvokeSystemCommand(["git", "clone", self._url, self._name])
-        else:
-            print("Updating repo {}...".format(self._url))
-            _InvokeSystemCommand(["git",  "-C", self._name, "pull", "origin", "master"])
+            # Only the manifests are ever read, and only at tagged revisions, so there's no need
+            # for a working tree, and blobs are only downloaded once they're read.
+            _InvokeSystemCommand([
+                "git", "clone", "--bare", "--filter=blob:none", self._url, self._name,
+            ])
+            return
 
-        stdout, stderr = _InvokeSystemCommand(["git", "-C", self._name, "show-ref", "--tags"])
-        for ref in stdout.split("\n"):
-            if ref:
-                m = re.search("^(\S+) refs/tags/(.*)$", ref)
-                self._revisions[DottedVersion(m.group(2))] = m.group(1)
+        refs_cache = self._readRefsCache()
+        if refs_cache and refs_cache["remote_refs_hash"] == self._remote_refs_hash:
+            self._cached_tags = refs_cache["tags"]
+            return
+
+        print("Updating repo {}...".format(self._url))
+        # Tags are fetched with an explicit forced refspec, so tags moved on the remote are updated
+        # and tags deleted from it are pruned, which --tags alone doesn't do.
+        _InvokeSystemCommand(self._git_argv + (
+            "fetch", "--prune", "origin", "+refs/tags/*:refs/tags/*",
+        ))
+
+    def loadRefs(self):
+        tags = self._cached_tags
+        if tags is None:
+            # Have git emit "<sha>\0<tag>" lines so no pattern matching is needed to split them.
+            stdout, stderr = _InvokeSystemCommand(self._git_argv + (
+                "for-each-ref",
+                "--format=%(objectname)%00%(refname:lstrip=2)",
+                "refs/tags",
+            ))
+            tags = {}
+            for ref in stdout.splitlines():
+                revision, tag = ref.split(b"\x00", 1)
+                tags[tag.decode()] = revision.decode()
+
+            Path(self._refs_cache_path).write_text(json.dumps({
+                "remote_refs_hash": self._remote_refs_hash,
+                "tags": tags,
+            }))
+
+        self._revisions = {DottedVersion(tag): revision for tag, revision in tags.items()}
+
+        # Versions are sorted once per refresh instead of on every resolution against this repo.
+        self._sorted_versions = sorted(self._revisions.keys(), key=lambda x: x._key)
+        self._sorted_version_keys = [x._key for x in self._sorted_versions]
+
+    def _fetchMissingManifests(self, revisions):
+        # Repos are cloned without blobs, and cat-file would fetch each missing manifest with a
+        # separate request while reading it. Listing the manifests at the revisions only reads
+        # trees, which are always local, so the missing ones are all downloaded in one fetch.
+        # --sparse keeps the revisions whose commit didn't change the manifest, which the pathspec
+        # would otherwise simplify away. Revisions and blobs are passed through stdin, as there may
+        # be too many of them for the command line.
+        stdout, stderr = _InvokeSystemCommand(
+            self._git_argv + (
+                "rev-list", "--objects", "--no-walk", "--sparse", "--missing=print", "--stdin",
+            ),
+            "".join(f"{x}\n" for x in revisions + ["--", "pesto.json"]).encode(),
+        )
+        missing_blobs = [x[1:] + b"\n" for x in stdout.splitlines() if x.startswith(b"?")]
+        if missing_blobs:
+            _InvokeSystemCommand(
+                self._git_argv + (
+                    "-c", "fetch.negotiationAlgorithm=noop",
+                    "fetch", "--quiet", "--no-tags", "--no-write-fetch-head", "--filter=blob:none",
+                    "--stdin", "origin",
+                ),
+                b"".join(missing_blobs),
+            )
+
+    def prefetchManifests(self, versions):
+        # Reads all the manifests in a single exchange with the cat-file process, instead of one
+        # request and response per version.
+        versions = [
+            x for x in dict.fromkeys(versions)
+            if x not in self._manifests and x not in self._prefetched_manifests
+        ]
+        if not versions:
+            return
+        revisions = [self._revisions[x] for x in versions]
+        self._fetchMissingManifests(revisions)
+        blobs = self._git_client.readBlobs([(x, "pesto.json") for x in revisions])
+        self._prefetched_manifests.update(zip(versions, blobs))
+
+    def manifestBytesAtVersion(self, version):
+        blob = self._prefetched_manifests.pop(version, None)
+        if blob is not None:
+            return blob
+        return self._git_client.readBlob(self._revisions[version], "pesto.json")
+
+    def manifestForBlob(self, blob_sha):
+        return _MANIFESTS_BY_BLOB.get(blob_sha)
+
+    def addManifest(self, version, blob_sha, manifest):
+        # Returns the manifest stored for the blob, which is the given one unless the same blob
+        # was added first by another thread.
+        with self._lock:
+            manifest = _MANIFESTS_BY_BLOB.setdefault(blob_sha, manifest)
+            self._manifests[version] = manifest
+            return manifest
 
     def manifestAtVersion(self, version):
-        if version in self._manifests:
-            return self._manifests[version]
+        manifest = self._manifests.get(version)
+        if manifest is not None:
+            return manifest
 
-        _InvokeSystemCommand(["git", "-C", self._name, "checkout", self._revisions[version]])
-        manifest = None
-        with open(os.path.join(self._name, "pesto.json")) as contents:
+        blob_sha, contents = self.manifestBytesAtVersion(version)
+        manifest = self.manifestForBlob(blob_sha)
+        if manifest is None:
             manifest = Manifest(contents)
-        self._manifests[version] = manifest
+        return self.addManifest(version, blob_sha, manifest)
 
-        return manifest
+    def peekManifest(self, version):
+        # Returns the manifest only if it was already read, without taking the lock or reading
+        # from git.
+        return self._manifests.get(version)
 
     def revisionForVersion(self, version):
         return self._revisions[version]
 
+    def lowestVersionInRange(self, version_range):
+        # Only the lowest version above the lower bound can be the lowest version within the
+        # range, so it's the only one that needs to be checked.
+        idx = bisect_left(self._sorted_version_keys, version_range.lower_bound._key)
+        if idx < len(self._sorted_versions) and version_range.contains(self._sorted_versions[idx]):
+            return self._sorted_versions[idx]
+        return None
+
 
 class GitResolver:
     def  __init__(self):
         self._cache = {}
+        self._lock = threading.Lock()
 
-    def getRepo(self, url):
-        if url in self._cache:
-            return self._cache[url]
+    def _fetchRepo(self, git_repo):
+        git_repo.fetch()
+        git_repo.loadRefs()
+
+    def fetchRepos(self, urls):
+        # Cloning and updating repos is mostly waiting on the network, so every repo that hasn't
+        # been fetched yet is fetched at once.
+        with self._lock:
+            new_repos = [GitRepo(x) for x in dict.fromkeys(urls) if x not in self._cache]
+            if not new_repos:
+                return
+
+            with ThreadPoolExecutor(max_workers=min(_MAX_FETCH_WORKERS, len(new_repos))) as executor:
+                list(executor.map(self._fetchRepo, new_repos))
+
+            for git_repo in new_repos:
+                self._cache[git_repo.url] = git_repo
 
-        self._cache[url] = GitRepo(url)
+    def getRepo(self, url):
+        if url not in self._cache:
+            self.fetchRepos([url])
         return self._cache[url]
 
 class LocalRepo:
     def __init__(self, path):
         self._path = path
+        self._manifest_path = f"{path}/pesto.json"
         self._manifest = None
 
     @property
     def manifest(self):
         if self._manifest:
             return self._manifest
-        with open(os.path.join(self._path, "pesto.json")) as contents:
-            self._manifest = Manifest(contents)
+        with open(self._manifest_path, "rb") as contents:
+            self._manifest = Manifest(contents.read())
         return self._manifest
 
 
 class Manifest:
-    def __init__(self, file, is_root=False):
+    def __init__(self, contents, is_root=False):
         self._deps = []
         self._initializer = None
         self._local_deps_allowed = is_root
@@ -297,15 +599,18 @@ class Manifest:
         self._bazel_compatible = None
         self._doc = None
 
-        self._parse_manifest(file)
+        self._parse_manifest(contents)
 
-    def _parse_manifest(self, file):
-        manifest_data = json.load(file)
+    def _parse_manifest(self, contents):
+        manifest_data = _json_loads(contents)
         deps = []
+        append_dep = deps.append
         self._name = manifest_data["name"]
         manifest_deps = manifest_data.get("deps", [])
         for dep_data in manifest_deps:
-            if "url" in dep_data:
+            url = dep_data.get("url")
+            path = dep_data.get("path")
+            if url is not None:
                 version_range = None
                 if "from" in dep_data:
                     version = DottedVersion(dep_data["from"])
@@ -333,19 +638,10 @@ class Manifest:
                     version_range = DottedVersionRange(version, version)
                 else:
                     raise VersionParseError("Couldn't find any version declaration.")
-                deps.append(
-                    ManifestRemoteDependency(
-                        url=dep_data["url"],
-                        version_range=version_range,
-                    )
-                )
-            elif "path" in dep_data:
+                append_dep(ManifestRemoteDependency(url, version_range))
+            elif path is not None:
                 if self._local_deps_allowed:
-                    deps.append(
-                        ManifestLocalDependency(
-                            path=dep_data["path"],
-                        )
-                    )
+                    append_dep(ManifestLocalDependency(path))
                 else:
                     raise LocalDepedencyNotAllowedError(
                         "Local dependencies are only allowed at root manifests.",
@@ -373,41 +669,11 @@ class Manifest:
         return self._initializer
 
 
-class ManifestInitializer:
-    def __init__(self, path, method):
-        self._path = path
-        self._method = method
+ManifestInitializer = namedtuple("ManifestInitializer", ["path", "method"])
 
-    @property
-    def path(self):
-        return self._path
+ManifestLocalDependency = namedtuple("ManifestLocalDependency", ["path"])
 
-    @property
-    def method(self):
-        return self._method
-
-
-class ManifestLocalDependency:
-    def __init__(self, path):
-      self._path = path
-
-    @property
-    def path(self):
-        return self._path
-
-
-class ManifestRemoteDependency:
-    def __init__(self, url, version_range):
-        self._url = url
-        self._version_range = version_range
-
-    @property
-    def url(self):
-        return self._url
-
-    @property
-    def version_range(self):
-        return self._version_range
+ManifestRemoteDependency = namedtuple("ManifestRemoteDependency", ["url", "version_range"])
 
 
 class RequestedLocalVersion:
@@ -446,223 +712,229 @@ class RequestedRemoteVersion:
     def version_range(self):
         return self._version_range
 
-class ResolvedLocalDependency:
-    def __init__(self, name, path, initializer):
-        self._name = name
-        self._path = path
-        self._initializer = initializer
-
-    @property
-    def name(self):
-        return self._name
-
-    @property
-    def path(self):
-        return self._path
-
-    @property
-    def initializer(self):
-        return self._initializer
-
-class ResolvedRemoteDependency:
-    def __init__(self, name, url, revision, initializer, version):
-        self._name = name
-        self._url = url
-        self._revision = revision
-        self._initializer = initializer
-        self._version = version
-
-    @property
-    def name(self):
-        return self._name
-
-    @property
-    def url(self):
-        return self._url
+    def intersect(self, version_range):
+        self._version_range = DottedVersionRange.intersect_iter(
+            (self._version_range, version_range),
+        )
 
-    @property
-    def revision(self):
-        return self._revision
 
-    @property
-    def initializer(self):
-        return self._initializer
+ResolvedLocalDependency = namedtuple("ResolvedLocalDependency", ["name", "path", "initializer"])
 
-    @property
-    def version(self):
-        return self._version
+ResolvedRemoteDependency = namedtuple(
+    "ResolvedRemoteDependency",
+    ["name", "url", "revision", "initializer", "version"],
+)
 
 
 class DependencyGraphCollector:
     def __init__(self, git_resolver):
-        self._dependencies = defaultdict(list)
+        # Requested version by dependency name. Requests are merged as they're collected, so only
+        # one is kept per dependency.
+        self._requested = {}
         self._git_resolver = git_resolver
+        # Repo and manifest of every local path and (url, lower version) pair already collected.
+        self._manifests = {}
 
-    def collect(self, deps):
-        transitive_deps = []
-        if not deps:
-            return
-
-        for dep in deps:
-            if isinstance(dep, ManifestLocalDependency):
-                local_repo = LocalRepo(dep.path)
-                dep_manifest = local_repo.manifest
-                self._dependencies[dep_manifest.name].append(
-                    RequestedLocalVersion(
-                        name=dep_manifest.name,
-                        local_repo=local_repo,
-                    ),
-                )
-                transitive_deps.extend(dep_manifest.dependencies)
-            else:
-                git_repo = self._git_resolver.getRepo(dep.url)
-                lower_version = dep.version_range.lower_bound
-                dep_manifest = git_repo.manifestAtVersion(lower_version)
-
-                self._dependencies[dep_manifest.name].append(
-                    RequestedRemoteVersion(
-                        name=dep_manifest.name,
-                        git_repo=git_repo,
-                        version_range=dep.version_range,
-                    ),
-                )
-                transitive_deps.extend(dep_manifest.dependencies)
-
-        if transitive_deps:
-            self.collect(transitive_deps)
-
-    @property
-    def collected(self):
-        return self._dependencies
-
+    def _fetchManifest(self, dep):
+        # Returns the dependency's repo along with either its manifest or, when the manifest still
+        # has to be parsed, the sha and contents of its blob.
+        if isinstance(dep, ManifestLocalDependency):
+            return None, LocalRepo(dep.path).manifest, None
+
+        git_repo = self._git_resolver.getRepo(dep.url)
+        version = dep.version_range.lower_bound
+        manifest = git_repo.peekManifest(version)
+        if manifest is None:
+            blob_sha, contents = git_repo.manifestBytesAtVersion(version)
+            manifest = git_repo.manifestForBlob(blob_sha)
+            if manifest is None:
+                return git_repo, None, (blob_sha, contents)
+            manifest = git_repo.addManifest(version, blob_sha, manifest)
+        return git_repo, manifest, None
+
+    def _parseManifests(self, contents):
+        # Parsing is CPU bound, so large batches are spread over several processes. Starting them
+        # costs far more than parsing a few small manifests, so smaller batches are parsed inline.
+        if len(contents) < _PARSE_PROCESSES_THRESHOLD:
+            return [Manifest(x) for x in contents]
+        with ProcessPoolExecutor() as executor:
+            return list(executor.map(Manifest, contents, chunksize=_PARSE_PROCESSES_CHUNK_SIZE))
+
+    def _manifestKey(self, dep):
+        if isinstance(dep, ManifestLocalDependency):
+            return (dep.path,)
+        return (dep.url, dep.version_range.lower_bound)
 
-class DependencyResolver:
-    def __init__(self, git_resolver):
-        self._git_resolver = git_resolver
-
-    def resolve(self, deps):
-        resolved = []
-        for dep_name, requested_versions in deps.items():
-            local_found = False
-            # TODO(kaipi): Validate that there's only 1 local repo for a specific dependency.
-            for version in requested_versions:
-                if isinstance(version, RequestedLocalVersion):
-                    resolved.append(
-                        ResolvedLocalDependency(
-                            name=dep_name,
-                            path=version.local_repo.path,
-                            initializer=version.local_repo.manifest.initializer,
+    def collect(self, deps):
+        # The graph is walked breadth first. Fetching repos and reading manifests, either local or
+        # remote, is I/O bound, so all the new repos of a level are cloned or updated concurrently,
+        # and then all of its manifests are read concurrently. The manifests that weren't parsed
+        # before are then parsed together.
+        frontier = list(deps)
+        with ThreadPoolExecutor(max_workers=_MAX_GIT_WORKERS) as executor:
+            while frontier:
+                # Shared dependencies are reached once per path in the graph, but each local path
+                # or (url, lower version) pair is only read and descended into once.
+                pending = {}
+                for dep in frontier:
+                    manifest_key = self._manifestKey(dep)
+                    if manifest_key not in self._manifests and manifest_key not in pending:
+                        pending[manifest_key] = dep
+
+                versions_by_url = {}
+                for dep in pending.values():
+                    if not isinstance(dep, ManifestLocalDependency):
+                        versions_by_url.setdefault(dep.url, []).append(
+                            dep.version_range.lower_bound,
                         )
-                    )
-                    local_found = True
-                    break
 
-            if not local_found:
-                version_ranges = [x.version_range for x in requested_versions]
-                intersection = DottedVersionRange.intersect(*version_ranges)
+                self._git_resolver.fetchRepos(versions_by_url.keys())
+                list(executor.map(
+                    lambda item: self._git_resolver.getRepo(item[0]).prefetchManifests(item[1]),
+                    versions_by_url.items(),
+                ))
+                results = list(executor.map(self._fetchManifest, pending.values()))
+                parsed_manifests = iter(self._parseManifests(
+                    [raw[1] for _, manifest, raw in results if manifest is None]
+                ))
+
+                next_frontier = []
+                for (manifest_key, dep), result in zip(pending.items(), results):
+                    git_repo, dep_manifest, raw_manifest = result
+                    if dep_manifest is None:
+                        dep_manifest = git_repo.addManifest(
+                            dep.version_range.lower_bound,
+                            raw_manifest[0],
+                            next(parsed_manifests),
+                        )
+                    self._manifests[manifest_key] = (git_repo, dep_manifest)
+                    next_frontier.extend(dep_manifest.dependencies)
 
-                # TODO(kaipi): Validate they don't come from different repos.
-                git_repo = requested_versions[0].git_repo
-                git_versions = git_repo.versions
-                git_versions.sort()
+                for dep in frontier:
+                    git_repo, dep_manifest = self._manifests[self._manifestKey(dep)]
+                    self._request(dep, git_repo, dep_manifest)
 
-                resolved_version = None
+                frontier = next_frontier
 
-                for version in git_versions:
-                    if intersection.contains(version):
-                        resolved_version = version
-                        break
+    def _request(self, dep, git_repo, dep_manifest):
+        dep_name = dep_manifest.name
+        requested = self._requested.get(dep_name)
+        if isinstance(dep, ManifestLocalDependency):
+            # Local dependencies override any remote dependency.
+            # TODO(kaipi): Validate that there's only 1 local repo for a specific dependency.
+            if not isinstance(requested, RequestedLocalVersion):
+                self._requested[dep_name] = RequestedLocalVersion(
+                    name=dep_name,
+                    path=dep.path,
+                    initializer=dep_manifest.initializer,
+                )
+        elif requested is None:
+            self._requested[dep_name] = RequestedRemoteVersion(
+                name=dep_name,
+                git_repo=git_repo,
+                version_range=dep.version_range,
+            )
+        elif isinstance(requested, RequestedRemoteVersion):
+            # TODO(kaipi): Validate they don't come from different repos.
+            requested.intersect(dep.version_range)
 
-                # TODO(kaipi): Validate there is a version that we can use.
+    @property
+    def resolved(self):
+        resolved = []
+        for dep_name, requested in self._requested.items():
+            if isinstance(requested, RequestedLocalVersion):
                 resolved.append(
-                    ResolvedRemoteDependency(
+                    ResolvedLocalDependency(
                         name=dep_name,
-                        url=git_repo.url,
-                        revision=git_repo.revisionForVersion(resolved_version),
-                        initializer=git_repo.manifestAtVersion(resolved_version).initializer,
-                        version=resolved_version,
-                    ),
+                        path=requested.path,
+                        initializer=requested.initializer,
+                    )
                 )
+                continue
+
+            git_repo = requested.git_repo
+            resolved_version = git_repo.lowestVersionInRange(requested.version_range)
+
+            # The resolved version usually is a lower bound whose manifest was already read while
+            # collecting the graph.
+            manifest = git_repo.peekManifest(resolved_version)
+            if manifest is None:
+                manifest = git_repo.manifestAtVersion(resolved_version)
+
+            # TODO(kaipi): Validate there is a version that we can use.
+            resolved.append(
+                ResolvedRemoteDependency(
+                    name=dep_name,
+                    url=git_repo.url,
+                    revision=git_repo.revisionForVersion(resolved_version),
+                    initializer=manifest.initializer,
+                    version=resolved_version,
+                ),
+            )
 
         return resolved
 
 
-class Printer:
-    def _version_comment(self, dep):
-        if isinstance(dep, ResolvedLocalDependency):
-            return "# {name}, path: {path}".format(
-                name=dep.name,
-                path=dep.path,
-            )
-        return "# {name}, version: {version}".format(
-            name=dep.name,
-            version=dep.version,
-        )
-
-    def _load_statement(self, dep):
-        if isinstance(dep, ResolvedLocalDependency):
-            return "local_repository(name = \"{name}\", path = \"{path}\")".format(
-                name=dep.name,
-                path=dep.path,
-            )
-        return "git_repository(name = \"{name}\", remote = \"{remote}\", commit = \"{revision}\")".format(
-            name=dep.name,
-            remote=dep.url,
-            revision=dep.revision,
-        )
-
-    def printLoadsFile(self, deps):
-        dep_versions = "\n".join(["{}".format(self._version_comment(x)) for x in deps])
-        dep_loads = "\n".join(["    {}".format(self._load_statement(x)) for x in deps])
-        return """# This file is generated. Do not modify.
+_LOADS_FILE_HEADER = """# This file is generated. Do not modify.
 
 load("@bazel_tools//tools/build_defs/repo:git.bzl", "git_repository")
 
-{versions}
+"""
 
-def pesto_load():
-{loads}
-""".format(versions=dep_versions, loads=dep_loads)
+_INITIALIZER_FILE_HEADER = """# This file is generated. Do not modify.
 
-    def _initializer_load(self, initializer):
-        return "load(\"{path}\", \"{method}\")".format(
-            path=initializer.path,
-            method=initializer.method,
-        )
-
-    def printInitializerFile(self, deps):
-        loads = "\n".join([self._initializer_load(x.initializer) for x in deps if x.initializer])
+"""
 
-        methods = "\n".join(["    {}()".format(x.initializer.method) for x in deps if x.initializer])
+class Printer:
+    def writeFiles(self, deps, loads_file, initializers_file):
+        # The dependencies are traversed once. Version comments go straight to the loads file,
+        # while the lines for the later sections are kept until the end.
+        loads = []
+        initializer_loads = []
+        initializer_methods = []
+
+        loads_file.write(_LOADS_FILE_HEADER)
+        for dep in deps:
+            if isinstance(dep, ResolvedLocalDependency):
+                loads_file.write(f"# {dep.name}, path: {dep.path}\n")
+                loads.append(f"    local_repository(name = \"{dep.name}\", path = \"{dep.path}\")\n")
+            else:
+                loads_file.write(f"# {dep.name}, version: {dep.version}\n")
+                loads.append(
+                    f"    git_repository(name = \"{dep.name}\", remote = \"{dep.url}\", "
+                    f"commit = \"{dep.revision}\")\n"
+                )
 
-        return """# This file is generated. Do not modify.
+            initializer = dep.initializer
+            if initializer:
+                initializer_loads.append(
+                    f"load(\"{initializer.path}\", \"{initializer.method}\")\n"
+                )
+                initializer_methods.append(f"    {initializer.method}()\n")
 
-{loads}
+        loads_file.write("\ndef pesto_load():\n")
+        loads_file.writelines(loads)
 
-def pesto_init():
-{methods}
-""".format(loads=loads, methods=methods)
+        initializers_file.write(_INITIALIZER_FILE_HEADER)
+        initializers_file.writelines(initializer_loads)
+        initializers_file.write("\ndef pesto_init():\n")
+        initializers_file.writelines(initializer_methods)
 
 class Driver:
     def run(self, args):
         manifest = None
-        with open(args[0]) as contents:
-            manifest = Manifest(contents, is_root=True)
+        with open(args[0], "rb") as contents:
+            manifest = Manifest(contents.read(), is_root=True)
 
         git_resolver = GitResolver()
         deps_collector = DependencyGraphCollector(git_resolver)
         deps_collector.collect(manifest.dependencies)
 
-        deps_resolver = DependencyResolver(git_resolver)
-        resolved_deps = deps_resolver.resolve(deps_collector.collected)
+        resolved_deps = deps_collector.resolved
 
         printer = Printer()
-
-        loads_file = open("load.bzl", "w")
-        loads_file.write(printer.printLoadsFile(resolved_deps))
-
-        initializers_file = open("init.bzl", "w")
-        initializers_file.write(printer.printInitializerFile(resolved_deps))
+        with open("load.bzl", "w") as loads_file, open("init.bzl", "w") as initializers_file:
+            printer.writeFiles(resolved_deps, loads_file, initializers_file)
         return 0
 
 if __name__ == "__main__":